@@ -1,18 +1,72 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import docker
+import errno
+import functools
+import json
 import logging
+import mmap
 import os
 import pathlib
-import pexpect
-import rclone
+import re
 import shutil
-from typing import Dict
+import socket
+import threading
+import time
+from typing import Dict, Optional, TYPE_CHECKING
 import zipfile
 
+if TYPE_CHECKING:
+    import docker
+
+# Size of the buffer used when streaming file contents
+BUFFER_SIZE = 1 << 20
+
+# Per-thread buffers used by get_copy_buffer
+COPY_BUFFERS = threading.local()
+
+# Smallest file that is memory mapped instead of read when os.sendfile is unavailable
+MMAP_THRESHOLD = 64 * 1024
+
+# Flags passed to every rclone call
+RCLONE_FLAGS = ["--transfers=32", "--checkers=32", "--buffer-size=16M", "--multi-thread-streams=4", "--use-mmap"]
+
+# Matches the full result of the 'save query' command, up to the end of the file list
+SAVE_QUERY_PATTERN = re.compile(rb"Data [^\n]*\n[^\n]+\n")
+
+# Matches the result of the 'save resume' command
+SAVE_RESUME_PATTERN = re.compile(rb"Changes to the (?:world|level) are resumed|A previous save has not been completed")
+
+# Matches each "name:bytes" entry of the 'save query' result, splitting on the last colon so names may contain colons
+FILE_PATTERN = re.compile(rb"\s*([^,\r\n]+):(\d+)")
+
+
+@functools.lru_cache(maxsize=1)
+def get_docker_api() -> "docker.APIClient":
+    """
+    Create the docker API client on first use
+    The client is cached, so its connection setup and version negotiation happen once per run
+
+    :return: The docker API client
+    """
+    import docker
+
+    return docker.from_env().api
+
+
+@functools.lru_cache(maxsize=1)
+def inspect_server() -> dict:
+    """
+    Inspect the server's container through the docker API
+    The result is cached, so the container is only inspected once per run
+
+    :return: The container's configuration, as returned by 'docker inspect'
+    """
+    return get_docker_api().inspect_container(server_name)
+
 
 def get_server_binds() -> str:
-    api: docker.APIClient = docker.APIClient()
-    binds = api.inspect_container(server_name)["HostConfig"]
+    binds = inspect_server()["HostConfig"]
 
     mount_point = ""
     for bind in binds["Binds"]:
@@ -30,46 +84,91 @@ def get_server_binds() -> str:
     return mount_point
 
 
-def query_save_server(child: pexpect.pty_spawn.spawn) -> str:
+def send_server_commands(commands: bytes, pattern: re.Pattern) -> Optional[bytes]:
     """
-    Execute the save hold/query/resume commands on the bedrock server.
-    These commands will be executed after attaching to the bedrock server
+    Write commands to the bedrock server's stdin over the docker attach socket,
+    then read the server's output until it matches the pattern
 
-    :param child: The pexpect child process
-    :return: A string containing the result of the 'save query' command
+    :param commands: The newline-terminated commands to send
+    :param pattern: The pattern marking the end of the expected output
+    :return: The bytes matched by the pattern, or None if the server did not answer in time
     """
-    commands = ["save hold", "save query", "save resume"]
-    expectations = [["Saving...", "The command is already running"],
-                    ["Data .+\n.+"],
-                    ["Changes to the world are resumed.", "A previous save has not been completed."]]
-
-    error: bool = False
-    save_query_result: str = ""
-    for i, (command, expectation) in enumerate(zip(commands, expectations)):
-        if error:
-            exit(1)
+    config: dict = inspect_server()["Config"]
+    if not config["OpenStdin"]:
+        logging.critical(f"Server '{server_name}' does not have stdin open (docker run -i), "
+                         f"so it cannot be sent commands")
+        exit(1)
 
-        try:
-            child.sendline(command)
-            child.expect(expectation, timeout=3)
+    tty: bool = config["Tty"]
+    attach_params: dict = {"stdin": 1, "stdout": 1, "stream": 1, "logs": 0}
+    attach_socket = get_docker_api().attach_socket(server_name, params=attach_params)
+    # Local sockets come back wrapped in a SocketIO, while TLS, ssh and npipe connections are returned as is
+    raw_socket = getattr(attach_socket, "_sock", attach_socket)
+    deadline: float = time.monotonic() + 3
+
+    # Without a TTY, docker prefixes each chunk of output with an 8 byte header ending in the chunk's size
+    frames = bytearray()
+    output = bytearray()
+    match = None
+    try:
+        raw_socket.sendall(commands)
+        while match is None:
+            raw_socket.settimeout(max(deadline - time.monotonic(), 0.001))
+            data: bytes = raw_socket.recv(4096)
+            if not data:
+                break
+
+            if tty:
+                output += data
+            else:
+                frames += data
+                while len(frames) >= 8:
+                    frame_end: int = 8 + int.from_bytes(frames[4:8], "big")
+                    if len(frames) < frame_end:
+                        break
+                    output += frames[8:frame_end]
+                    del frames[:frame_end]
+
+            match = pattern.search(output)
+            if match is None:
+                # The patterns span at most two lines, so nothing before the last two lines can start a match
+                del output[:output.rfind(b"\n", 0, output.rfind(b"\n")) + 1]
+    except socket.timeout:
+        pass
+    finally:
+        attach_socket.close()
+
+    return match.group(0) if match else None
+
+
+def query_save_server() -> bytes:
+    """
+    Execute the save hold/query commands on the bedrock server.
+    The server keeps the world files unchanged until resume_save_server is called
 
-            if command == "save query":
-                save_query_result: str = child.after.decode()
+    :return: The raw bytes of the 'save query' result
+    """
+    save_query_result = send_server_commands(b"save hold\nsave query\n", SAVE_QUERY_PATTERN)
 
-        except pexpect.exceptions.TIMEOUT:
-            logging.error(f"Unable to find {expectation} in command {command} to server {server_name}")
-            error = True
+    if save_query_result is None:
+        logging.error(f"Unable to find the 'save query' result from server {server_name}")
+        resume_save_server()
+        exit(1)
 
+    return save_query_result
 
-    child.sendcontrol("p")
-    child.sendcontrol("q")
 
-    child.close()
+def resume_save_server() -> None:
+    """
+    Execute the save resume command on the bedrock server, allowing it to write to the world files again
 
-    return save_query_result
+    :return: None
+    """
+    if send_server_commands(b"save resume\n", SAVE_RESUME_PATTERN) is None:
+        logging.error(f"Unable to confirm that saving was resumed on server {server_name}")
 
 
-def get_files_dictionary(query_result: str) -> Dict[str, int]:
+def get_files_dictionary(query_result: bytes) -> Dict[str, int]:
     """
     This function will produce a dictionary of file names and byte values to read
 
@@ -82,16 +181,7 @@ def get_files_dictionary(query_result: str) -> Dict[str, int]:
     :param query_result: The result from the query_save_server function
     :return: A dictionary containing strings as keys and integers as values
     """
-    files: str = query_result.split("\n")[1]
-    file_list: list = files.split(", ")
-
-    file_name_list: list = [name.split(":")[0] for name in file_list]
-    file_name_byte: list = [name.split(":")[1].rstrip() for name in file_list]
-    files_dictionary: dict[str:int] = {}
-    for i, (name, byte) in enumerate(zip(file_name_list, file_name_byte)):
-        files_dictionary[name] = int(byte)
-
-    return files_dictionary
+    return {name.decode(): int(byte) for name, byte in FILE_PATTERN.findall(query_result)}
 
 
 def create_directory(item_path: str, file_name_included: bool = True):
@@ -112,59 +202,198 @@ def create_directory(item_path: str, file_name_included: bool = True):
     :return:
     """
 
-    if file_name_included:
-        directory_path = item_path.split("/")[:-1]
-        directory_path = os.path.join("/".join(directory_path))
-    else:
-        directory_path = item_path
+    directory_path = os.path.dirname(item_path) if file_name_included else item_path
 
     os.makedirs(directory_path, exist_ok=True)
 
 
+def get_copy_buffer() -> bytearray:
+    """
+    Get the copy buffer belonging to the current thread, allocating it on first use
+    Each worker in write_backups reuses its own buffer instead of allocating new bytes for every read
+
+    :return: A bytearray of BUFFER_SIZE bytes
+    """
+    buffer = getattr(COPY_BUFFERS, "buffer", None)
+    if buffer is None:
+        buffer = COPY_BUFFERS.buffer = bytearray(BUFFER_SIZE)
+
+    return buffer
+
+
+def copy_file_bytes(read_file_path: str, save_file_path: str, read_bytes: int) -> None:
+    """
+    Copy the first read_bytes bytes of read_file_path to save_file_path
+
+    os.copy_file_range, then os.sendfile, are used where available so the copy happens in the kernel
+    Otherwise, files of at least MMAP_THRESHOLD bytes are memory mapped and written straight from the mapping,
+    and smaller files are streamed through the thread's reusable copy buffer
+
+    :param read_file_path: The path of the file to read from
+    :param save_file_path: The path of the file to write to
+    :param read_bytes: The number of bytes to copy
+    :return: None
+    """
+    with open(read_file_path, "rb", buffering=0) as i_stream, open(save_file_path, "wb", buffering=0) as o_stream:
+        remaining: int = read_bytes
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while remaining:
+                    copied: int = os.copy_file_range(i_stream.fileno(), o_stream.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError as error:
+                # Older kernels and some filesystem pairs do not support copy_file_range, continue with sendfile
+                if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+
+        if hasattr(os, "sendfile"):
+            offset: int = read_bytes - remaining
+            while remaining:
+                sent: int = os.sendfile(o_stream.fileno(), i_stream.fileno(), offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+        elif read_bytes >= MMAP_THRESHOLD:
+            length: int = min(read_bytes, os.fstat(i_stream.fileno()).st_size)
+            if length:
+                with mmap.mmap(i_stream.fileno(), length, access=mmap.ACCESS_READ) as mapped, \
+                        memoryview(mapped) as view:
+                    written: int = 0
+                    while written < length:
+                        written += o_stream.write(view[written:])
+        else:
+            with memoryview(get_copy_buffer()) as view:
+                while remaining:
+                    read: int = i_stream.readinto(view[:min(remaining, BUFFER_SIZE)])
+                    if not read:
+                        break
+                    o_stream.write(view[:read])
+                    remaining -= read
+
+
+def update_backup_file(read_file_path: str, save_file_path: str, read_bytes: int) -> None:
+    """
+    Copy a world file into the temp_backup_path location, unless the copy from an earlier backup is still current
+    Like rsync, each copy is given the world file's modification time,
+    so the earlier copy is current if it holds exactly read_bytes bytes and its modification time is the same
+
+    :param read_file_path: The path of the world file
+    :param save_file_path: The path of the copy under temp_backup_path
+    :param read_bytes: The number of bytes to copy
+    :return: None
+    """
+    read_stat = os.stat(read_file_path)
+    try:
+        save_stat = os.stat(save_file_path)
+        if save_stat.st_size == read_bytes and save_stat.st_mtime_ns == read_stat.st_mtime_ns:
+            return
+    except FileNotFoundError:
+        pass
+
+    copy_file_bytes(read_file_path, save_file_path, read_bytes)
+    os.utime(save_file_path, ns=(read_stat.st_atime_ns, read_stat.st_mtime_ns))
+
+
+def remove_stale_backups(save_paths: set) -> None:
+    """
+    Remove any file under temp_backup_path that is not part of the current backup, and any folder left empty
+    These are world files the server has since deleted, worlds that were renamed or switched,
+    or archives left behind by an interrupted run
+
+    :param save_paths: The paths under temp_backup_path that belong to the current backup
+    :return: None
+    """
+    # Walk bottom-up so a folder is only checked for emptiness once its contents have been handled
+    for directory, _, file_names in os.walk(temp_backup_path, topdown=False):
+        for file_name in file_names:
+            file_path = os.path.normpath(os.path.join(directory, file_name))
+            if file_path not in save_paths:
+                os.remove(file_path)
+
+        if os.path.normpath(directory) != os.path.normpath(temp_backup_path) and not os.listdir(directory):
+            os.rmdir(directory)
+
+
 def write_backups(files_dict: Dict[str, int]):
     """
     Write files to the temp_backup_path location
 
+    The folder is kept between backups, so only files that changed since the last backup are copied
+    Parent directories are created once up front, then the files are copied concurrently
+
     :param files_dict: A dictionary containing input file paths as the keys and bytes to read as values
     :return: None
     """
-    for i, file_name in enumerate(files_dict):
+    read_root: str = str(path) + os.sep
+    save_root: str = temp_backup_path + os.sep
 
-        save_file_path: os.path = os.path.join(temp_backup_path, file_name)
-        create_directory(save_file_path, True)
+    remove_stale_backups({os.path.normpath(save_root + file_name) for file_name in files_dict})
 
-        read_file_path: os.path = os.path.join(path, file_name)
-        read_bytes: int = files_dict[file_name]
+    # makedirs creates every parent, so directories that are the parent of another one can be skipped
+    directories: set = {os.path.dirname(save_root + file_name) for file_name in files_dict}
+    directories -= {os.path.dirname(directory) for directory in directories}
+    for directory in directories:
+        create_directory(directory, False)
 
-        with open(read_file_path, "rb") as i_stream:
-            lines = i_stream.read(read_bytes)
+    workers: int = max(1, min(8, (os.cpu_count() or 1) * 2, len(files_dict)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(update_backup_file, read_root + file_name, save_root + file_name, read_bytes)
+                   for file_name, read_bytes in files_dict.items()]
 
-        with open(save_file_path, "wb") as o_stream:
-            o_stream.write(lines)
+        for future in futures:
+            future.result()
 
 
-def rclone_upload(file_path: str) -> None:
+async def rclone_copy(file_path: str, upload_path: str) -> bool:
     """
-    Upload items in the temp_backup_path to the rclone_path path
+    Upload the file at file_path to a single rclone upload path
+
+    :param file_path: The path of the file to upload
+    :param upload_path: The rclone destination, in the form "remote:path"
     :return: True if upload successful, otherwise False
     """
-    cfg: str = open(rclone_config, "r").read()
-    rclone_agent = rclone.with_config(cfg)
+    remote_name = upload_path.split(":")[0]
+    logging.info(f"Starting upload to {remote_name}")
+    process = await asyncio.create_subprocess_exec("rclone", "--config", rclone_config, *RCLONE_FLAGS,
+                                                   "--bwlimit", upload_bandwidth_limit,
+                                                   "copy", file_path, upload_path,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        logging.error(f"Upload to {remote_name} failed with exit code {process.returncode}: {stderr.decode().strip()}")
+        return False
 
-    for path in upload_paths:
-        remote_name = path.split(":")[0]
-        logging.info(f"Starting upload to {remote_name}")
-        rclone_agent.copy(file_path, path)
-        logging.info(f"Finished upload to {remote_name}")
+    logging.info(f"Finished upload to {remote_name}")
+    return True
 
 
-def rename_backup_folder() -> str:
+async def rclone_upload(file_path: str) -> bool:
+    """
+    Upload the file at file_path to each of the upload_paths
+    The uploads to each remote run at the same time
+    :return: True if every upload successful, otherwise False
     """
-    This function will rename the folder under the temp_backup_path
+    return all(await asyncio.gather(*(rclone_copy(file_path, upload_path) for upload_path in upload_paths)))
+
+
+def zip_temp_backup(files_dict: Dict[str, int]) -> str:
+    """
+    This function will bundle the folder under the temp_backup_path into a single zip archive
     It will save in the following format
-        YYYY-MM-DD-[FOLDER NAME].zip
+        YYYY-MM-DD--HH-MM-SS--[FOLDER NAME].zip
 
-    It will return a string of the new file path (/tmp/backups/YYY-MM-DD-[FOLDER NAME])
+    The files are stored under a folder of the same name inside the archive
+    They are stored without compression, as the world's ldb files are already compressed
+
+    It will return a string of the archive path (/tmp/backups/YYY-MM-DD--HH-MM-SS--[FOLDER NAME].zip)
+
+    :param files_dict: A dictionary containing input file paths as the keys and bytes to read as values
     """
 
     current_date = datetime.datetime.now()
@@ -175,23 +404,77 @@ def rename_backup_folder() -> str:
     minute = f"{current_date.minute:02d}"
     second = f"{current_date.second:02d}"
 
-    previous_folder_name = os.listdir(temp_backup_path)[0]
-    previous_folder_path = os.path.join(temp_backup_path, previous_folder_name)
+    # Every file the server lists sits under the world's folder
+    folder_name = next(iter(files_dict)).split("/")[0]
+    folder_path = os.path.join(temp_backup_path, folder_name)
 
-    new_folder_name = f"{year}-{month}-{day}--{hour}-{minute}-{second}--{previous_folder_name}"
-    new_folder_path = os.path.join(temp_backup_path, new_folder_name)
+    archive_name = f"{year}-{month}-{day}--{hour}-{minute}-{second}--{folder_name}"
+    zip_path = os.path.join(temp_backup_path, f"{archive_name}.zip")
 
-    shutil.rmtree(new_folder_path, ignore_errors=True)
-    shutil.move(previous_folder_path, new_folder_path)
+    # ZipFile.write copies in 8 KiB chunks, so each file is streamed into the archive with BUFFER_SIZE chunks instead
+    with open(zip_path, "wb", buffering=BUFFER_SIZE) as zip_stream, \
+            zipfile.ZipFile(zip_stream, "w", compression=zipfile.ZIP_STORED) as zip_file:
+        for directory, _, file_names in os.walk(folder_path):
+            archive_directory = os.path.normpath(os.path.join(archive_name, os.path.relpath(directory, folder_path)))
+            for file_name in file_names:
+                file_path = os.path.join(directory, file_name)
+                zip_info = zipfile.ZipInfo.from_file(file_path, os.path.join(archive_directory, file_name))
+                zip_info.compress_type = zipfile.ZIP_STORED
 
-    return new_folder_path
+                with open(file_path, "rb", buffering=0) as i_stream, zip_file.open(zip_info, "w") as o_stream:
+                    shutil.copyfileobj(i_stream, o_stream, BUFFER_SIZE)
 
+    return zip_path
 
-def remove_temp_backup_path(backup_path: str):
+
+def get_files_manifest(files_dict: Dict[str, int]) -> Dict[str, list]:
     """
-    Remove the temporary files that exist at the backup path location
+    This function will produce a manifest describing the current state of each world file
+
+    {
+        FILE_1: [SIZE, MODIFIED_NS, BYTES_TO_READ],
+        FILE_2: [SIZE, MODIFIED_NS, BYTES_TO_READ]
+    }
+
+    :param files_dict: A dictionary containing input file paths as the keys and bytes to read as values
+    :return: A dictionary containing strings as keys and lists of integers as values
     """
-    shutil.rmtree(os.path.expanduser(backup_path))
+    manifest: Dict[str, list] = {}
+    for file_name, read_bytes in files_dict.items():
+        stat = os.stat(os.path.join(path, file_name))
+        manifest[file_name] = [stat.st_size, stat.st_mtime_ns, read_bytes]
+
+    return manifest
+
+
+def read_manifest() -> Dict[str, list]:
+    """
+    Read the manifest saved by the previous successful backup
+
+    :return: The previous manifest, or an empty dictionary if there is none
+    """
+    try:
+        return json.loads(pathlib.Path(manifest_file).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(manifest: Dict[str, list]) -> None:
+    """
+    Save the manifest of the current backup so the next run can compare against it
+
+    :param manifest: The manifest produced by get_files_manifest
+    :return: None
+    """
+    pathlib.Path(manifest_file).write_text(json.dumps(manifest))
+
+
+def remove_backup_archive(zip_path: str):
+    """
+    Remove the uploaded archive
+    The rest of the temp_backup_path location is kept, so the next backup only copies the files that changed
+    """
+    os.remove(zip_path)
 
 
 if __name__ == '__main__':
@@ -201,26 +484,49 @@ if __name__ == '__main__':
     log_mode = "a"  # append
     log_format = "%(asctime)s %(levelname)s\t:  %(message)s"  # Should not be changed
     date_format = "%Y/%m/%d %H:%M:%S"
-    logging.basicConfig(filename=log_file, level=log_level, filemode=log_mode, format=log_format, datefmt=date_format)
+    log_handlers = [logging.FileHandler(log_file, mode=log_mode), logging.StreamHandler()]
+    logging.basicConfig(handlers=log_handlers, level=log_level, format=log_format, datefmt=date_format)
 
     # These values SHOULD be modified before running the server
     server_name: str = "survival"
     temp_backup_path: str = os.path.expanduser("/tmp/bedrock-server-backups")
     upload_paths: list[str] = ["onedrive:rclone/backup/bedrock-server/1.18"]
+    upload_bandwidth_limit: str = "off"  # rclone --bwlimit value, such as "10M" or "08:00,512k 23:00,off"
 
     # These values SHOULD NOT be modified before running the server
     worlds_path: str = get_server_binds()
-    docker_attach: str = f"docker attach {server_name}"
     rclone_config: str = os.path.expanduser("~/.config/rclone/rclone.conf")
+    manifest_file: str = os.path.join(os.path.dirname(log_file), "manifest.json")
     # -------
 
     path = pathlib.Path(worlds_path)
-    child: pexpect.pty_spawn.spawn = pexpect.spawn(docker_attach)
-    query_result: str = query_save_server(child)
-    files_list = get_files_dictionary(query_result)
+    query_result: bytes = query_save_server()
+    try:
+        files_list = get_files_dictionary(query_result)
+        if not files_list:
+            logging.error(f"The 'save query' result from server {server_name} did not list any files")
+            exit(1)
+
+        try:
+            files_manifest = get_files_manifest(files_list)
+        except FileNotFoundError as error:
+            logging.error(f"File '{error.filename}' listed by server {server_name} does not exist under {worlds_path}")
+            exit(1)
+
+        if files_manifest == read_manifest():
+            logging.info(f"No world files have changed on server {server_name} since the last backup")
+            exit(0)
 
-    write_backups(files_list)
-    rename_backup_folder()
+        write_backups(files_list)
+    finally:
+        resume_save_server()
 
-    rclone_upload(temp_backup_path)
-    remove_temp_backup_path(temp_backup_path)
+    backup_zip = zip_temp_backup(files_list)
+
+    uploaded: bool = asyncio.run(rclone_upload(backup_zip))
+    remove_backup_archive(backup_zip)
+
+    # Only a fully uploaded backup may let the next run skip an unchanged world
+    if not uploaded:
+        exit(1)
+    write_manifest(files_manifest)